@@ -0,0 +1,111 @@
+# scripts/FastAPI/batcher.py
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+from collections.abc import Callable
+
+from anyio import CapacityLimiter, to_thread
+
+logger = logging.getLogger("moodle_rag")
+
+
+class GenerationBatcher[PromptT]:
+    """Динамический батчинг генерации: копит запросы до max_batch_size или max_delay.
+
+    Декодирование LLM упирается в чтение весов из памяти, поэтому батч из
+    нескольких промптов стоит почти столько же, сколько один промпт.
+    """
+
+    def __init__(
+        self,
+        generate_batch: Callable[[list[PromptT]], list[str]],
+        limiter: CapacityLimiter,
+        max_batch_size: int = 4,
+        max_delay: float = 0.05,
+    ) -> None:
+        self.generate_batch = generate_batch
+        self.limiter = limiter
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue[tuple[PromptT, asyncio.Future[str]]] | None = None
+        self._task: asyncio.Task[None] | None = None
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._server_loop())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+        # Запросы, оставшиеся в очереди, больше никто не обработает.
+        assert self._queue is not None
+        stopped = RuntimeError("GenerationBatcher is stopped")
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(stopped)
+        self._queue = None
+
+    async def submit(self, prompt: PromptT) -> str:
+        if self._queue is None:
+            raise RuntimeError("GenerationBatcher is not started")
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+
+    async def _collect_batch(self) -> list[tuple[PromptT, asyncio.Future[str]]]:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except TimeoutError:
+                break
+            except asyncio.CancelledError:
+                # stop() во время сбора батча: уже вынутые из очереди запросы иначе повисли бы.
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("GenerationBatcher is stopped"))
+                raise
+        return batch
+
+    async def _server_loop(self) -> None:
+        while True:
+            batch = await self._collect_batch()
+            # Клиент мог отключиться, пока запрос ждал в очереди.
+            batch = [(prompt, future) for prompt, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            try:
+                answers = await to_thread.run_sync(
+                    self.generate_batch,
+                    [prompt for prompt, _ in batch],
+                    limiter=self.limiter,
+                )
+                for (_, future), answer in zip(batch, answers, strict=True):
+                    if not future.done():
+                        future.set_result(answer)
+            except Exception as exc:
+                logger.exception("Generation batch of %d prompts failed", len(batch))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+            finally:
+                # Цикл отменён посреди батча (stop): ответа уже не будет, ждущие запросы не должны висеть.
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("GenerationBatcher is stopped"))
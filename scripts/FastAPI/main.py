@@ -1,23 +1,89 @@
+import asyncio
+import logging
+import os
 import time
-from collections.abc import Callable
-
-from fastapi.responses import Response
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from queue import Queue
+
+from anyio import CapacityLimiter, to_thread
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
 
 from fastapi import FastAPI, Request
+from scripts.FastAPI.batcher import GenerationBatcher
 from scripts.FastAPI.rag_service import (
+    GenerationRequest,
     build_context,
-    generate_answer,
+    build_prompt,
+    cache_fingerprint,
+    embed_query,
+    generate_answers_batch,
+    load_llm,
+    load_retriever,
+    load_translator,
+    max_new_tokens,
     retrieval_query_with_context,
+    stream_answer,
+)
+from scripts.FastAPI.semantic_cache import CachedAnswer, SemanticCache, load_caches, save_caches
+from scripts.FastAPI.streaming import iterate_in_thread, sse_event
+
+# MLX держит модель на одном GPU/ANE: батчи генерации идут строго по одному,
+# а эмбеддинги и поиск в Chroma идут параллельно в общем пуле потоков.
+mlx_limiter = CapacityLimiter(1)
+THREAD_POOL_SIZE = 16
+batcher = GenerationBatcher[GenerationRequest](
+    generate_answers_batch, limiter=mlx_limiter, max_batch_size=4, max_delay=0.05
 )
+# Отдельный кэш на (язык ответа, k): язык и число источников меняют ответ.
+# Сохраняется на диск при остановке и подхватывается при старте, если индекс, эмбеддер и LLM те же (cache_fingerprint).
+# Путь по умолчанию считается от корня проекта, а не от текущей директории uvicorn.
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+SEMANTIC_CACHE_PATH = Path(os.environ.get("MOODLE_SEMANTIC_CACHE_PATH", PROJECT_ROOT / ".state" / "semantic_cache.pkl"))
+semantic_caches: dict[tuple[str, int], SemanticCache] = {}
+
+# Логи запросов кладутся в очередь, а форматирование и вывод идут в потоке QueueListener,
+# чтобы не блокировать event loop.
+log_queue: Queue[logging.LogRecord] = Queue()
+logger = logging.getLogger("moodle_rag")
+logger.setLevel(logging.INFO)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
+    log_listener.start()
+    # Модель MLX, ретривер (BGE + Chroma) и переводчик грузятся параллельно в потоках, не блокируя импорт модуля.
+    # Загруженное хранится в rag_service; обработчики получают его через get_llm() / get_retriever().
+    await asyncio.gather(
+        to_thread.run_sync(load_llm), to_thread.run_sync(load_retriever), to_thread.run_sync(load_translator)
+    )
+    fingerprint = await to_thread.run_sync(cache_fingerprint)
+    semantic_caches.update(load_caches(SEMANTIC_CACHE_PATH, fingerprint))
+    await batcher.start()
+    try:
+        yield
+    finally:
+        await batcher.stop()
+        save_caches(SEMANTIC_CACHE_PATH, semantic_caches, fingerprint)
+        log_listener.stop()
+
 
-app = FastAPI(title="Moodle RAG API", version="0.1.0")
+app = FastAPI(title="Moodle RAG API", version="0.1.0", lifespan=lifespan)
 
 
 class ChatRequest(BaseModel):
     message: str
     history: list[dict[str, str]] = Field(default_factory=list)
-    k: int = 5
+    # k входит в ключ семантического кэша, поэтому ограничен: иначе каждый новый k заводит новый кэш.
+    k: int = Field(5, ge=1, le=20)
 
 
 class ChatResponse(BaseModel):
@@ -39,33 +105,102 @@ async def simple_middleware(request: Request, call_next: Callable) -> Response:
 
     process_time = time.time() - start
     response.headers["X-Process-Time"] = f"{process_time:.4f}"
-    print(f"{request.method} {request.url.path} -> {response.status_code} ({process_time:.4f}s)")
+    logger.info("%s %s -> %s (%.4fs)", request.method, request.url.path, response.status_code, process_time)
 
     return response  # type: ignore[no-any-return]
 
 
-@app.post("/chat", response_model=ChatResponse)
-def chat(payload: ChatRequest) -> ChatResponse:
+def get_semantic_cache(user_lang: str, k: int) -> SemanticCache:
+    cache = semantic_caches.get((user_lang, k))
+    if cache is None:
+        cache = semantic_caches[(user_lang, k)] = SemanticCache(threshold=0.97, max_size=1024)
+    return cache
+
+
+def collect_links(results: list[tuple]) -> tuple[list[str], list[str]]:  # type: ignore[type-arg]
+    # dict как упорядоченное множество: дубли убираются, ссылки идут в порядке ранга документов.
+    source_links: dict[str, None] = {}
+    youtube_links: dict[str, None] = {}
+    for doc, _ in results:
+        source_links.update(dict.fromkeys(doc.metadata.get("source_links") or ()))
+        youtube_links.update(dict.fromkeys(doc.metadata.get("youtube_links") or ()))
+    return list(source_links), list(youtube_links)
+
+
+async def lookup_cached(payload: ChatRequest) -> tuple[list[float], SemanticCache | None, CachedAnswer | None]:
+    """Эмбеддинг запроса + поиск в семантическом кэше. cache=None — кэш для запроса не используется."""
+    rq = retrieval_query_with_context(payload.message, payload.history)
+    query_embedding, user_lang = await to_thread.run_sync(embed_query, rq)
+
+    # История диалога влияет на ответ, поэтому кэшируем только запросы без неё.
+    if payload.history:
+        return query_embedding, None, None
+    cache = get_semantic_cache(user_lang, payload.k)
+    return query_embedding, cache, cache.lookup(query_embedding)
+
+
+def render_prompt(payload: ChatRequest, query_embedding: list[float]) -> tuple[GenerationRequest, list[tuple]]:  # type: ignore[type-arg]
+    """Поиск, рендер шаблона и токенизация — CPU-работа, поэтому вызывается в потоке целиком."""
     rq = retrieval_query_with_context(payload.message, payload.history)
-    context, user_lang, results = build_context(rq, k=payload.k)
-    answer = generate_answer(
+    context, user_lang, results = build_context(rq, k=payload.k, query_embedding=query_embedding)
+    prompt, n_ctx_tokens = build_prompt(
         payload.message,
         context,
         user_lang,
         recent_history=payload.history[-6:],
     )
+    return (prompt, max_new_tokens(n_ctx_tokens)), results
 
-    source_links: list[str] = []
-    youtube_links: list[str] = []
-    for doc, _ in results:
-        source_links.extend(doc.metadata.get("source_links", []) or [])
-        youtube_links.extend(doc.metadata.get("youtube_links", []) or [])
 
-    return ChatResponse(
-        answer=answer,
-        source_links=sorted(set(source_links)),
-        youtube_links=sorted(set(youtube_links)),
-    )
+async def prepare_prompt(
+    payload: ChatRequest, query_embedding: list[float]
+) -> tuple[GenerationRequest, list[str], list[str]]:
+    request, results = await to_thread.run_sync(render_prompt, payload, query_embedding)
+    source_links, youtube_links = collect_links(results)
+    return request, source_links, youtube_links
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(payload: ChatRequest) -> ChatResponse:
+    query_embedding, cache, cached = await lookup_cached(payload)
+    if cached is not None:
+        return ChatResponse(
+            answer=cached.answer,
+            source_links=cached.source_links,
+            youtube_links=cached.youtube_links,
+        )
+
+    prompt, source_links, youtube_links = await prepare_prompt(payload, query_embedding)
+    answer = await batcher.submit(prompt)
+
+    if cache is not None:
+        cache.add(query_embedding, CachedAnswer(answer, source_links, youtube_links))
+    return ChatResponse(answer=answer, source_links=source_links, youtube_links=youtube_links)
+
+
+@app.post("/chat/stream")
+async def chat_stream(payload: ChatRequest) -> StreamingResponse:
+    """То же, что /chat, но ответ идёт SSE-событиями: token (кусок текста), затем links."""
+    query_embedding, cache, cached = await lookup_cached(payload)
+
+    async def events() -> AsyncIterator[str]:
+        if cached is not None:
+            yield sse_event("token", cached.answer)
+            yield sse_event("links", {"source_links": cached.source_links, "youtube_links": cached.youtube_links})
+            return
+
+        prompt, source_links, youtube_links = await prepare_prompt(payload, query_embedding)
+        parts: list[str] = []
+        async for text in iterate_in_thread(partial(stream_answer, prompt), limiter=mlx_limiter):
+            parts.append(text)
+            yield sse_event("token", text)
+        yield sse_event("links", {"source_links": source_links, "youtube_links": youtube_links})
+
+        if cache is not None:
+            cache.add(query_embedding, CachedAnswer("".join(parts), source_links, youtube_links))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 # uvicorn scripts.FastAPI.main:app --reload
+# прод: uvicorn scripts.FastAPI.main:app --loop uvloop --http httptools
@@ -2,93 +2,137 @@
 
 from __future__ import annotations
 
+import logging
 import os
+import re
+import threading
+from collections.abc import Iterator
+from functools import lru_cache
 from pathlib import Path
+from typing import Any
 
 from deep_translator import GoogleTranslator
 from dotenv import load_dotenv
 from langchain_chroma import Chroma
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+from langchain_core.embeddings import Embeddings
 from langdetect import detect
-from mlx_lm import generate, load
+from mlx_lm import batch_generate, generate, load, stream_generate
+
+from scripts.bge_onnx import BgeOnnxEmbeddings
+from scripts.chroma_settings import HNSW_METADATA
 
 load_dotenv()
 
-# --- init (максимально просто: один раз при импорте) ---
+logger = logging.getLogger("moodle_rag")
+
 CHUNKS_DIR = Path(os.environ["MOODLE_CHUNKS_DIR"])  # если не нужен, можно удалить
 PERSIST_DIR = os.environ["MOODLE_CHROMA_DB_DIR"]
 COLLECTION_NAME = os.environ.get("MOODLE_COLLECTION_NAME", "moodle_docs")
 
-hf_embeddings = HuggingFaceBgeEmbeddings(
-    model_name="BAAI/bge-base-en-v1.5",
-    model_kwargs={"device": "cpu"},
-    encode_kwargs={"normalize_embeddings": True},
-)
+# Если модель экспортирована в ONNX int8 (см. scripts/bge_onnx), используем её: в 2–4 раза быстрее на CPU.
+BGE_ONNX_DIR = os.environ.get("MOODLE_BGE_ONNX_DIR")
 
-vector_store = Chroma(
-    collection_name=COLLECTION_NAME,
-    embedding_function=hf_embeddings,
-    persist_directory=PERSIST_DIR,
-)
+LLM_MODEL_NAME = "mlx-community/Qwen2.5-7B-Instruct-4bit"
 
-model, tokenizer = load("mlx-community/Qwen2.5-7B-Instruct-4bit")  # type: ignore[misc]
+# Локальный MarianMT ru→en (имя на HF Hub или путь к локальной копии); GoogleTranslator остаётся запасным вариантом.
+RU_EN_MODEL_NAME = os.environ.get("MOODLE_RU_EN_MODEL", "Helsinki-NLP/opus-mt-ru-en")
 
+# --- тяжёлые ресурсы: загружаются не при импорте, а в lifespan приложения (load_retriever / load_llm) ---
+hf_embeddings: Embeddings | None = None
+vector_store: Chroma | None = None
+model: Any = None
+tokenizer: Any = None
+ru_en_model: Any = None
+ru_en_tokenizer: Any = None
 
-# --- функции из ноутбука ---
-def prepare_query(user_query: str) -> tuple[str, str]:
-    text = (user_query or "").strip()
-    if not text:
-        return "", "ru"
+
+def load_retriever() -> tuple[Embeddings, Chroma]:
+    global hf_embeddings, vector_store
+
+    embeddings: Embeddings
+    if BGE_ONNX_DIR:
+        embeddings = BgeOnnxEmbeddings(BGE_ONNX_DIR)
+    else:
+        embeddings = HuggingFaceBgeEmbeddings(
+            model_name="BAAI/bge-base-en-v1.5",
+            model_kwargs={"device": "cpu"},
+            encode_kwargs={"normalize_embeddings": True},
+        )
+
+    store = Chroma(
+        collection_name=COLLECTION_NAME,
+        embedding_function=embeddings,
+        persist_directory=PERSIST_DIR,
+        collection_metadata=HNSW_METADATA,
+    )
+    hf_embeddings, vector_store = embeddings, store
+    return embeddings, store
+
+
+def load_llm() -> tuple[Any, Any]:
+    global model, tokenizer
+
+    model, tokenizer = load(LLM_MODEL_NAME)  # type: ignore[misc]
+    return model, tokenizer
+
+
+def load_translator() -> tuple[Any, Any] | None:
+    global ru_en_model, ru_en_tokenizer
+
+    # transformers импортируем здесь: сам импорт занимает секунды и нужен только при старте сервиса.
+    # Модель грузим напрямую, без pipeline: в transformers 5 задачи "translation" больше нет.
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 
     try:
-        lang = detect(text)
+        tokenizer_ru_en = AutoTokenizer.from_pretrained(RU_EN_MODEL_NAME)
+        model_ru_en = AutoModelForSeq2SeqLM.from_pretrained(RU_EN_MODEL_NAME).eval()
     except Exception:
-        lang = "ru"
+        # Нет модели в кэше, нет сети или sentencepiece — переводим через GoogleTranslator.
+        logger.warning(
+            "RU->EN model %s is not loaded, falling back to GoogleTranslator", RU_EN_MODEL_NAME, exc_info=True
+        )
+        ru_en_model = ru_en_tokenizer = None
+        return None
+    ru_en_model, ru_en_tokenizer = model_ru_en, tokenizer_ru_en
+    return ru_en_model, ru_en_tokenizer
 
-    if lang not in ("ru", "en"):
-        lang = "en"
 
-    if lang == "ru":
-        try:
-            query_en = GoogleTranslator(source="ru", target="en").translate(text)
-            if not query_en:
-                query_en = text
-        except Exception:
-            query_en = text
-    else:
-        query_en = text
+def cache_fingerprint() -> dict[str, Any]:
+    """От чего зависят ответы семантического кэша: если что-то изменилось, сохранённый кэш не подхватывается."""
+    embeddings, store = get_retriever()
+    return {
+        "collection": COLLECTION_NAME,
+        # id меняется при пересоздании коллекции, даже если имя и директория те же.
+        "collection_id": str(store._collection.id),
+        "persist_dir": str(Path(PERSIST_DIR).resolve()),
+        "embedder": str(Path(BGE_ONNX_DIR).resolve()) if BGE_ONNX_DIR else "BAAI/bge-base-en-v1.5",
+        "embedding_dim": len(embeddings.embed_query("dimension probe")),
+        "llm": LLM_MODEL_NAME,
+    }
 
-    return query_en, lang
 
+def get_retriever() -> tuple[Embeddings, Chroma]:
+    if hf_embeddings is None or vector_store is None:
+        raise RuntimeError("Retriever is not loaded: call load_retriever() first")
+    return hf_embeddings, vector_store
 
-def build_context(user_query: str, k: int = 5) -> tuple[str, str, list[tuple]]:  # type: ignore[type-arg]
-    query_en, user_lang = prepare_query(user_query)
-    results = vector_store.similarity_search_with_score(query_en, k=k)
-
-    context_blocks = []
-    for i, (doc, score) in enumerate(results, 1):
-        context_blocks.append(
-            f"[{i}]\n"
-            f"doc_title: {doc.metadata.get('doc_title', 'unknown')}\n"
-            f"distance: {float(score):.4f}\n"
-            f"source_links: {doc.metadata.get('source_links', [])}\n"
-            f"youtube_links: {doc.metadata.get('youtube_links', [])}\n"
-            f"text:\n{doc.page_content}"
-        )
 
-    context = "\n\n---\n\n".join(context_blocks)
-    return context, user_lang, results
+def get_llm() -> tuple[Any, Any]:
+    if model is None or tokenizer is None:
+        raise RuntimeError("LLM is not loaded: call load_llm() first")
+    return model, tokenizer
 
 
-def generate_answer(
-    user_query: str,
-    context: str,
-    user_lang: str,
-    recent_history: list[dict[str, str]] | None = None,
-) -> str:
-    answer_lang = "Russian" if user_lang == "ru" else "English"
+MAX_NEW_TOKENS = 550
+MIN_NEW_TOKENS = 96
+# Блок контекста обрезается до размера чанка, чтобы prefill не разрастался на длинных документах.
+MAX_CONTEXT_CHARS = 1200
 
-    system_prompt = f"""
+# Запрос на генерацию: токены промпта и лимит новых токенов для него.
+GenerationRequest = tuple[list[int], int]
+
+SYSTEM_PROMPT_TEMPLATE = """
     <ROLE_DEFINITION>
     You are the official Moodle documentation assistant acting as a technical consultant.
     </ROLE_DEFINITION>
@@ -120,9 +164,134 @@ def generate_answer(
     - source_links: [list of links from CONTEXT]
     - youtube_links: [list of links from CONTEXT if available; if none — write "none"]
     </OUTPUT_FORMAT_REQUIREMENTS>
-    """.strip()
+    """
+
+
+CYRILLIC_RE = re.compile(r"[а-яё]", re.IGNORECASE)
+LATIN_RE = re.compile(r"[a-z]", re.IGNORECASE)
+
+# GoogleTranslator хранит текст запроса в полях объекта, поэтому один экземпляр на поток.
+_translators = threading.local()
+
+
+def _ru_en_translator() -> GoogleTranslator:
+    translator = getattr(_translators, "ru_en", None)
+    if translator is None:
+        translator = _translators.ru_en = GoogleTranslator(source="ru", target="en")
+    return translator
+
 
-    messages: list[dict[str, str]] = [{"role": "system", "content": system_prompt}]
+# Токенизатор Marian не рассчитан на вызовы из нескольких потоков; перевод короткого запроса занимает десятки мс.
+_ru_en_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4096)
+def translate_ru_en(text: str) -> str:
+    if ru_en_model is not None:
+        with _ru_en_lock:
+            inputs = ru_en_tokenizer([text], return_tensors="pt", truncation=True)
+            output_ids = ru_en_model.generate(**inputs, max_length=256)
+            translated = ru_en_tokenizer.decode(output_ids[0], skip_special_tokens=True)
+        return translated or text
+    # Исключения не кэшируются lru_cache: при сбое сети следующий вызов повторит запрос.
+    return _ru_en_translator().translate(text) or text
+
+
+# --- функции из ноутбука ---
+def prepare_query(user_query: str) -> tuple[str, str]:
+    text = (user_query or "").strip()
+    if not text:
+        return "", "ru"
+
+    # Латиница без кириллицы: langdetect не вернёт "ru", а всё остальное и так сводится к "en".
+    if LATIN_RE.search(text) and not CYRILLIC_RE.search(text):
+        return text, "en"
+
+    try:
+        lang = detect(text)
+    except Exception:
+        lang = "ru"
+
+    if lang not in ("ru", "en"):
+        lang = "en"
+
+    if lang == "ru":
+        try:
+            query_en = translate_ru_en(text)
+        except Exception:
+            query_en = text
+    else:
+        query_en = text
+
+    return query_en, lang
+
+
+def embed_query(user_query: str) -> tuple[list[float], str]:
+    query_en, user_lang = prepare_query(user_query)
+    embeddings, _ = get_retriever()
+    return embeddings.embed_query(query_en), user_lang
+
+
+# Один шаблон на блок контекста: один format вместо шести f-строк и их конкатенации.
+_CTX_TPL = (
+    "[{i}]\n"
+    "doc_title: {doc_title}\n"
+    "distance: {score:.4f}\n"
+    "source_links: {source_links}\n"
+    "youtube_links: {youtube_links}\n"
+    "text:\n{page_content}"
+)
+
+
+def build_context(
+    user_query: str,
+    k: int = 5,
+    query_embedding: list[float] | None = None,
+) -> tuple[str, str, list[tuple]]:  # type: ignore[type-arg]
+    query_en, user_lang = prepare_query(user_query)
+    embeddings, store = get_retriever()
+    # Эмбеддинг запроса считаем один раз: если он уже есть (из embed_query), BGE не вызываем повторно.
+    if query_embedding is None:
+        query_embedding = embeddings.embed_query(query_en)
+    results = store.similarity_search_by_vector_with_relevance_scores(query_embedding, k=k)
+
+    context = "\n\n---\n\n".join(
+        _CTX_TPL.format(
+            i=i,
+            doc_title=doc.metadata.get("doc_title", "unknown"),
+            score=float(score),
+            source_links=doc.metadata.get("source_links", []),
+            youtube_links=doc.metadata.get("youtube_links", []),
+            page_content=doc.page_content[:MAX_CONTEXT_CHARS],
+        )
+        for i, (doc, score) in enumerate(results, 1)
+    )
+    return context, user_lang, results
+
+
+def system_prompt(answer_lang: str) -> str:
+    return SYSTEM_PROMPT_TEMPLATE.format(answer_lang=answer_lang).strip()
+
+
+@lru_cache(maxsize=2)
+def system_prefix(answer_lang: str) -> tuple[str, tuple[int, ...]]:
+    """Отрендеренный system-блок чата и его токены: одинаковы для всех запросов с тем же языком ответа."""
+    _, tokenizer = get_llm()
+    messages = [{"role": "system", "content": system_prompt(answer_lang)}]
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+    return text, tuple(tokenizer.encode(text, add_special_tokens=False))
+
+
+def build_prompt(
+    user_query: str,
+    context: str,
+    user_lang: str,
+    recent_history: list[dict[str, str]] | None = None,
+) -> tuple[list[int], int]:
+    """Токены промпта и число токенов контекста в нём (для max_new_tokens)."""
+    answer_lang = "Russian" if user_lang == "ru" else "English"
+
+    messages: list[dict[str, str]] = [{"role": "system", "content": system_prompt(answer_lang)}]
 
     if recent_history:
         for m in recent_history:
@@ -140,8 +309,59 @@ def generate_answer(
         }
     )
 
-    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    return generate(model, tokenizer, prompt=prompt, max_tokens=550)
+    _, tokenizer = get_llm()
+    # Шаблон рендерим целиком (Qwen подставляет свой system, если его нет), а токенизируем только хвост.
+    prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    prefix_text, prefix_ids = system_prefix(answer_lang)
+    if prompt_text.startswith(prefix_text):
+        tail_text = prompt_text[len(prefix_text) :]
+    else:
+        tail_text, prefix_ids = prompt_text, ()
+
+    # Смещения токенов показывают, какие из них пришлись на контекст, — отдельно контекст не токенизируем.
+    encoding = tokenizer.backend_tokenizer.encode(tail_text, add_special_tokens=False)
+    ctx_start = tail_text.rfind(context) if context else -1
+    n_ctx_tokens = 0
+    if ctx_start >= 0:
+        ctx_end = ctx_start + len(context)
+        n_ctx_tokens = sum(1 for start, end in encoding.offsets if start < ctx_end and end > ctx_start)
+    return [*prefix_ids, *encoding.ids], n_ctx_tokens
+
+
+def max_new_tokens(n_ctx_tokens: int) -> int:
+    """Чем больше контекста (в токенах), тем короче ответ: 550 токенов без контекста, не меньше 96."""
+    return min(MAX_NEW_TOKENS, max(MIN_NEW_TOKENS, MAX_NEW_TOKENS - n_ctx_tokens // 8))
+
+
+def generate_answer(
+    user_query: str,
+    context: str,
+    user_lang: str,
+    recent_history: list[dict[str, str]] | None = None,
+) -> str:
+    prompt, n_ctx_tokens = build_prompt(user_query, context, user_lang, recent_history)
+    model, tokenizer = get_llm()
+    return generate(model, tokenizer, prompt=prompt, max_tokens=max_new_tokens(n_ctx_tokens))
+
+
+def stream_answer(request: GenerationRequest) -> Iterator[str]:
+    model, tokenizer = get_llm()
+    prompt, max_tokens = request
+    for response in stream_generate(model, tokenizer, prompt=prompt, max_tokens=max_tokens):
+        yield response.text
+
+
+def generate_answers_batch(requests: list[GenerationRequest]) -> list[str]:
+    """Один батчевый прогон MLX для нескольких промптов (паддинг делает mlx_lm)."""
+    model, tokenizer = get_llm()
+    # BatchGenerator сам сортирует промпты по длине, а ответы возвращает в порядке входа.
+    response = batch_generate(
+        model,
+        tokenizer,
+        prompts=[prompt for prompt, _ in requests],
+        max_tokens=[max_tokens for _, max_tokens in requests],
+    )
+    return response.texts  # type: ignore[no-any-return]
 
 
 def retrieval_query_with_context(query: str, chat_history: list[dict[str, str]]) -> str:
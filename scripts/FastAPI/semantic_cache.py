@@ -0,0 +1,102 @@
+# scripts/FastAPI/semantic_cache.py
+
+from __future__ import annotations
+
+import pickle
+from collections.abc import Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+# Матрица эмбеддингов растёт блоками (удвоением) до max_size, а не выделяется целиком на первом add.
+INITIAL_ROWS = 64
+
+
+@dataclass(frozen=True)
+class CachedAnswer:
+    answer: str
+    source_links: list[str]
+    youtube_links: list[str]
+
+
+class SemanticCache:
+    """Кэш ответов по близости эмбеддингов запроса (cosine >= threshold).
+
+    Эмбеддинги BGE уже нормированы (normalize_embeddings=True), поэтому
+    косинус — это просто скалярное произведение. Индекс — плоская матрица
+    в памяти (аналог FAISS IndexFlatIP), при переполнении вытесняется
+    запись, к которой дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, threshold: float = 0.97, max_size: int = 1024) -> None:
+        self.threshold = threshold
+        self.max_size = max_size
+        self._vectors: npt.NDArray[np.float32] | None = None
+        self._payloads: list[CachedAnswer | None] = [None] * max_size
+        self._last_used = np.zeros(max_size, dtype=np.int64)
+        self._size = 0
+        self._clock = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def lookup(self, embedding: Sequence[float]) -> CachedAnswer | None:
+        if self._vectors is None or self._size == 0:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = self._vectors[: self._size] @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        self._clock += 1
+        self._last_used[best] = self._clock
+        return self._payloads[best]
+
+    def add(self, embedding: Sequence[float], payload: CachedAnswer) -> None:
+        vector = np.asarray(embedding, dtype=np.float32)
+        if self._vectors is None:
+            self._vectors = np.zeros((min(INITIAL_ROWS, self.max_size), vector.shape[0]), dtype=np.float32)
+        if self._size < self.max_size:
+            slot = self._size
+            self._size += 1
+            if slot == len(self._vectors):
+                grown = np.zeros((min(2 * slot, self.max_size), self._vectors.shape[1]), dtype=np.float32)
+                grown[:slot] = self._vectors
+                self._vectors = grown
+        else:
+            slot = int(np.argmin(self._last_used))
+        self._clock += 1
+        self._vectors[slot] = vector
+        self._payloads[slot] = payload
+        self._last_used[slot] = self._clock
+
+
+def save_caches(path: Path, caches: dict[tuple[str, int], SemanticCache], fingerprint: dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("wb") as f:
+        pickle.dump({"fingerprint": fingerprint, "caches": caches}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path.replace(path)
+
+
+def load_caches(path: Path, fingerprint: dict[str, Any]) -> dict[tuple[str, int], SemanticCache]:
+    """Загружает кэш, сохранённый save_caches с тем же fingerprint.
+
+    Другой fingerprint (пересобранная коллекция, другой эмбеддер или LLM), битый или чужой файл — пустой кэш.
+    """
+    if not path.exists():
+        return {}
+    try:
+        with path.open("rb") as f:
+            saved = pickle.load(f)
+    except Exception:
+        return {}
+    if not isinstance(saved, dict) or saved.get("fingerprint") != fingerprint:
+        return {}
+    caches = saved.get("caches")
+    if not isinstance(caches, dict):
+        return {}
+    return caches
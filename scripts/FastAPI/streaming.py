@@ -0,0 +1,61 @@
+# scripts/FastAPI/streaming.py
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from collections.abc import AsyncIterator, Callable, Iterator
+from typing import Any
+
+import orjson
+from anyio import CapacityLimiter, to_thread
+
+logger = logging.getLogger("moodle_rag")
+
+
+def sse_event(event: str, data: Any) -> str:
+    """Одно событие Server-Sent Events; data кодируется в JSON (токены могут содержать переводы строк)."""
+    # orjson пишет UTF-8 как есть (как ensure_ascii=False) и вызывается на каждый токен, поэтому не stdlib json.
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+def _log_producer_error(task: asyncio.Future[None]) -> None:
+    if not task.cancelled() and (exc := task.exception()) is not None:
+        logger.error("Streaming generation failed", exc_info=exc)
+
+
+async def iterate_in_thread(
+    make_iterator: Callable[[], Iterator[str]],
+    limiter: CapacityLimiter,
+) -> AsyncIterator[str]:
+    """Прогоняет синхронный генератор целиком в одном рабочем потоке и отдаёт его элементы в event loop.
+
+    Лимитер удерживается на всю генерацию. Если клиент отключился, генерация
+    останавливается на следующем токене.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[str | None] = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce() -> None:
+        try:
+            # Клиент мог отключиться, пока поток ждал лимитер: тогда и prefill не запускаем.
+            if stop.is_set():
+                return
+            for item in make_iterator():
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    producer = asyncio.ensure_future(to_thread.run_sync(produce, limiter=limiter))
+    # При раннем выходе producer никто не ждёт: его ошибку забираем и пишем в лог здесь.
+    producer.add_done_callback(_log_producer_error)
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+        await producer
+    finally:
+        stop.set()
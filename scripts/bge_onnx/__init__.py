@@ -0,0 +1,3 @@
+from .bge_onnx import BgeOnnxEmbeddings
+
+__all__ = ["BgeOnnxEmbeddings"]
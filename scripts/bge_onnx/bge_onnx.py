@@ -0,0 +1,73 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+import onnxruntime as ort
+from langchain_core.embeddings import Embeddings
+from tokenizers import Tokenizer
+
+# Та же инструкция, что у HuggingFaceBgeEmbeddings по умолчанию — векторы совместимы с уже собранной БД.
+BGE_QUERY_INSTRUCTION = "Represent this question for searching relevant passages: "
+
+
+class BgeOnnxEmbeddings(Embeddings):
+    """BGE-base через ONNX Runtime (int8) и быстрый Rust-токенизатор.
+
+    Модель экспортируется один раз:
+        optimum-cli export onnx --model BAAI/bge-base-en-v1.5 --task feature-extraction --optimize O3 bge_onnx/
+        optimum-cli onnxruntime quantize --onnx_model bge_onnx/ --avx512_vnni -o bge_onnx_int8/
+    (на Apple Silicon вместо --avx512_vnni используется --arm64).
+    """
+
+    MAX_LENGTH = 512
+
+    def __init__(
+        self,
+        model_dir: str | Path,
+        file_name: str = "model_quantized.onnx",
+        batch_size: int = 32,
+        num_threads: int | None = None,
+    ) -> None:
+        model_dir = Path(model_dir)
+        self.batch_size = batch_size
+
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.MAX_LENGTH)
+        self.tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads or os.cpu_count() or 1
+        self.session = ort.InferenceSession(
+            str(model_dir / file_name),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def _encode(self, texts: list[str]) -> npt.NDArray[np.float32]:
+        encodings = self.tokenizer.encode_batch(texts)
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        feeds = {name: value for name, value in feeds.items() if name in self.input_names}
+        last_hidden_state = self.session.run(None, feeds)[0]
+
+        # BGE использует CLS-пулинг + L2-нормализацию (normalize_embeddings=True).
+        cls = last_hidden_state[:, 0]
+        norms = np.linalg.norm(cls, axis=1, keepdims=True)
+        return (cls / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        texts = [t.replace("\n", " ") for t in texts]
+        embeddings: list[list[float]] = []
+        for start in range(0, len(texts), self.batch_size):
+            embeddings.extend(self._encode(texts[start : start + self.batch_size]).tolist())
+        return embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        embedding: list[float] = self._encode([BGE_QUERY_INSTRUCTION + text.replace("\n", " ")])[0].tolist()
+        return embedding
@@ -0,0 +1,4 @@
+"""Chroma collection settings shared by the indexing CLI (embed_chunks) and the FastAPI service."""
+
+# HNSW settings are applied only when the collection is created; rebuild the collection to change them.
+HNSW_METADATA = {"hnsw:space": "cosine", "hnsw:M": 32, "hnsw:construction_ef": 200, "hnsw:search_ef": 64}
@@ -2,10 +2,16 @@
 """Simple markdown chunker: read .md files and save chunks as .md files."""
 
 import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+# One splitter per worker process, created by init_worker.
+_splitter: RecursiveCharacterTextSplitter | None = None
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Split markdown files into chunks and save as .md.")
@@ -14,35 +20,48 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--glob", default="*.md")
     parser.add_argument("--chunk-size", type=int, default=1100)
     parser.add_argument("--chunk-overlap", type=int, default=160)
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes. Use 0 for os.cpu_count().")
     return parser.parse_args()
 
 
+def init_worker(chunk_size: int, chunk_overlap: int) -> None:
+    global _splitter
+    _splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=["\n\n", "\n", ". ", " ", ""],
+    )
+
+
+def process_file(path: Path, output_dir: Path) -> int:
+    assert _splitter is not None
+    text = path.read_text(encoding="utf-8")
+    chunks = _splitter.split_text(text)
+
+    doc_dir = output_dir / path.stem
+    doc_dir.mkdir(parents=True, exist_ok=True)
+
+    for i, chunk in enumerate(chunks):
+        chunk_path = doc_dir / f"chunk_{i:04d}.md"
+        chunk_path.write_text(chunk.strip() + "\n", encoding="utf-8")
+    return len(chunks)
+
+
 def main() -> None:
     args = parse_args()
     input_dir = Path(args.input_dir)
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=args.chunk_size,
-        chunk_overlap=args.chunk_overlap,
-        separators=["\n\n", "\n", ". ", " ", ""],
-    )
-
     files = sorted(input_dir.glob(args.glob))
-    total_chunks = 0
-
-    for path in files:
-        text = path.read_text(encoding="utf-8")
-        chunks = splitter.split_text(text)
-
-        doc_dir = output_dir / path.stem
-        doc_dir.mkdir(parents=True, exist_ok=True)
+    workers = args.workers or os.cpu_count() or 1
 
-        for i, chunk in enumerate(chunks):
-            chunk_path = doc_dir / f"chunk_{i:04d}.md"
-            chunk_path.write_text(chunk.strip() + "\n", encoding="utf-8")
-            total_chunks += 1
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(args.chunk_size, args.chunk_overlap),
+    ) as executor:
+        total_chunks = sum(executor.map(partial(process_file, output_dir=output_dir), files, chunksize=8))
 
     print(f"Done. Files: {len(files)}, chunks: {total_chunks}")
     print(f"Output dir: {output_dir}")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Embed markdown chunks with BGE in parallel worker processes and write them into Chroma.
+
+Run from the project root: python -m scripts.embed_chunks
+"""
+
+import argparse
+import ast
+import contextlib
+import os
+import re
+from collections.abc import Iterator
+from itertools import islice
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Any
+
+import chromadb
+from chromadb.errors import NotFoundError
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+from scripts.chroma_settings import HNSW_METADATA
+
+CHUNK_META_RE = re.compile(r"^\s*---\s*\n(.*?)\n---\s*\n?(.*)$", re.DOTALL)
+
+# Each worker process keeps its own single-threaded model copy.
+_embeddings: Embeddings | None = None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Embed chunk .md files with BGE and store them in Chroma.")
+    parser.add_argument("--chunks-dir", default=os.environ.get("MOODLE_CHUNKS_DIR", "data/moodle_docs/chunks_md"))
+    parser.add_argument("--persist-dir", default=os.environ.get("MOODLE_CHROMA_DB_DIR"))
+    parser.add_argument("--collection", default=os.environ.get("MOODLE_COLLECTION_NAME", "moodle_docs"))
+    parser.add_argument(
+        "--onnx-dir",
+        default=os.environ.get("MOODLE_BGE_ONNX_DIR"),
+        help="Directory with BGE exported to ONNX int8 (see scripts/bge_onnx). PyTorch BGE is used if omitted.",
+    )
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes. Use 0 for os.cpu_count().")
+    parser.add_argument(
+        "--reset",
+        action="store_true",
+        help="Delete the collection first. Required to replace a collection built elsewhere (e.g. by the notebook).",
+    )
+    args = parser.parse_args()
+    if not args.persist_dir:
+        parser.error("--persist-dir or MOODLE_CHROMA_DB_DIR is required")
+    return args
+
+
+def parse_chunk_file(path: Path) -> tuple[str, dict[str, Any]]:
+    text = path.read_text(encoding="utf-8").strip()
+    m = CHUNK_META_RE.match(text)
+    if not m:
+        return text, {"source_file": str(path)}
+
+    try:
+        metadata = ast.literal_eval(m.group(1).strip())
+        if not isinstance(metadata, dict):
+            metadata = {}
+    except Exception:
+        metadata = {}
+
+    metadata["source_file"] = str(path)
+    # Chroma rejects empty lists in metadata.
+    metadata = {k: v for k, v in metadata.items() if not (isinstance(v, list) and len(v) == 0)}
+    return m.group(2).strip(), metadata
+
+
+def iter_chunks(chunks_dir: Path) -> Iterator[tuple[str, str, dict[str, Any]]]:
+    for path in sorted(chunks_dir.rglob("chunk_*.md")):
+        content, metadata = parse_chunk_file(path)
+        if content:
+            yield path.relative_to(chunks_dir).as_posix(), content, metadata
+
+
+def iter_batches(
+    items: Iterator[tuple[str, str, dict[str, Any]]], batch_size: int
+) -> Iterator[list[tuple[str, str, dict[str, Any]]]]:
+    while batch := list(islice(items, batch_size)):
+        yield batch
+
+
+def init_worker(onnx_dir: str | None) -> None:
+    global _embeddings
+    if onnx_dir:
+        from scripts.bge_onnx import BgeOnnxEmbeddings
+
+        _embeddings = BgeOnnxEmbeddings(onnx_dir, num_threads=1)
+    else:
+        import torch
+        from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+
+        torch.set_num_threads(1)
+        _embeddings = HuggingFaceBgeEmbeddings(
+            model_name="BAAI/bge-base-en-v1.5",
+            model_kwargs={"device": "cpu"},
+            encode_kwargs={"normalize_embeddings": True},
+        )
+
+
+def embed_batch(
+    batch: list[tuple[str, str, dict[str, Any]]],
+) -> tuple[list[tuple[str, str, dict[str, Any]]], list[list[float]]]:
+    assert _embeddings is not None
+    return batch, _embeddings.embed_documents([content for _, content, _ in batch])
+
+
+def check_own_collection(collection: Any) -> None:
+    """Refuse to upsert into a collection filled by someone else.
+
+    Ids here are chunk paths ("doc/chunk_000.md"); create_vectorDB.ipynb writes random UUIDs. Upserting into
+    such a collection would store every chunk a second time and top-k retrieval would return duplicates.
+    """
+    ids = collection.get(limit=100, include=[])["ids"]
+    foreign = [chunk_id for chunk_id in ids if not chunk_id.endswith(".md")]
+    if foreign:
+        raise SystemExit(
+            f"Collection {collection.name!r} already holds chunks with other ids (e.g. {foreign[0]!r}). "
+            "Use --reset to rebuild it, or pick another --collection/--persist-dir."
+        )
+
+
+def main() -> None:
+    load_dotenv()
+    args = parse_args()
+    chunks_dir = Path(args.chunks_dir)
+    workers = args.workers or os.cpu_count() or 1
+
+    client = chromadb.PersistentClient(path=args.persist_dir)
+    if args.reset:
+        with contextlib.suppress(NotFoundError):
+            client.delete_collection(args.collection)
+    collection = client.get_or_create_collection(args.collection, metadata=HNSW_METADATA)
+    check_own_collection(collection)
+
+    total = 0
+    batches = iter_batches(iter_chunks(chunks_dir), args.batch_size)
+    with Pool(processes=workers, initializer=init_worker, initargs=(args.onnx_dir,)) as pool:
+        for batch, embeddings in pool.imap(embed_batch, batches):
+            collection.upsert(
+                ids=[chunk_id for chunk_id, _, _ in batch],
+                embeddings=embeddings,
+                documents=[content for _, content, _ in batch],
+                metadatas=[metadata for _, _, metadata in batch],
+            )
+            total += len(batch)
+            print(f"Indexed: {total}")
+
+    print(f"Done. Chunks: {total}, workers: {workers}")
+    print(f"Collection: {args.collection} ({args.persist_dir})")
+
+
+if __name__ == "__main__":
+    main()
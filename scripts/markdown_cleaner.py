@@ -0,0 +1,223 @@
+"""Markdown cleanup for prepare_markdown_corpus: pure string functions, kept apart so they can be compiled.
+
+The module is plain typed Python and works as is. For the hot per-line loop it can be compiled with mypyc
+(ships with mypy, see the dev dependencies; needs setuptools). From the project root:
+
+    mypyc --no-warn-unused-configs scripts/markdown_cleaner.py
+
+The resulting extension in scripts/ is picked up instead of this file; delete the .so files to go back.
+"""
+
+import re
+from typing import Final
+
+FOOTER_MARKERS: Final = (
+    'retrieved from "[',
+    "[tools](",
+    "[what links here](",
+    "[related changes](",
+    "[special pages](",
+    "[printable version](",
+    "[permanent link](",
+    "[page information](",
+    "[in other languages](",
+    "this page was last edited",
+    "content is available under",
+    "[privacy](",
+    "[about moodle docs](",
+    "[disclaimers](",
+    "[accessibility statement](",
+    "[![powered by mediawiki]",
+)
+
+DOCS_VERSIONS_RE: Final = re.compile(r"\d\.\d docs(?: \d\.\d docs)+")
+IMAGE_RE: Final = re.compile(r"!\[([^\]]*)\]\(([^)]+)\)")
+LINK_RE: Final = re.compile(r"\[([^\]]+)\]\(([^)]+)\)")
+BACKTICKS_RE: Final = re.compile(r"`{1,3}")
+
+DROP_EXACT_LINES: Final = {
+    "Menu",
+    "Main page",
+    "Table of contents",
+    "Docs overview",
+    "Recent changes",
+    "Log in",
+    "Article",
+    "View history",
+    "From MoodleDocs",
+    "Load video",
+    "YouTube",
+    "Continue",
+    "---",
+}
+
+DROP_LINE_STARTS: Final = (
+    "# Documentation",
+    "[Main page](",
+    "[Table of contents](",
+    "[Docs overview](",
+    "[Recent changes](",
+    "[Random page](",
+    "[Category index](",
+    "[Global search](",
+    "[log in](",
+    "[4.5 docs](",
+    "[4.4 docs](",
+    "[article](",
+    "[page comments](",
+    "[view source](",
+    "[view history](",
+)
+
+
+def group_drop_starts(prefixes: tuple[str, ...]) -> dict[str, tuple[tuple[str, ...], tuple[str, ...]]]:
+    """Group prefixes by first character into (mixed-case, lowercase) tuples.
+
+    A mixed-case prefix like "[Main page](" can only match the original line, and a lowercase one like
+    "[log in](" matches the lowered line whenever it matches the original, so each prefix needs one test.
+    """
+    groups: dict[str, tuple[tuple[str, ...], tuple[str, ...]]] = {}
+    for prefix in prefixes:
+        cased, lower = groups.get(prefix[:1], ((), ()))
+        if prefix == prefix.lower():
+            lower = (*lower, prefix)
+        else:
+            cased = (*cased, prefix)
+        groups[prefix[:1]] = (cased, lower)
+    return groups
+
+
+# All drop prefixes start with "#" or "[" (case-invariant characters), so for most lines
+# one dict lookup on the first character replaces the prefix scans.
+DROP_LINE_STARTS_BY_FIRST: Final = group_drop_starts(DROP_LINE_STARTS)
+
+
+def clean_title(title: str, fallback: str = "Untitled") -> str:
+    raw = (title or "").strip()
+    if not raw:
+        return fallback
+    return raw.split(" - ", 1)[0].strip() or fallback
+
+
+def strip_markdown_to_text(markdown: str, title: str) -> str:
+    lines = markdown.splitlines()
+    # Pre-scan: every line is stripped exactly once; the H1 search and the filter loop below share the result.
+    stripped = [line.strip() for line in lines]
+    expected_h1 = f"# {title}".strip()
+    try:
+        start_idx = stripped.index(expected_h1)
+    except ValueError:
+        start_idx = next((i for i, s in enumerate(stripped) if s.startswith("# ")), 0)
+
+    out: list[str] = []
+    in_toc = False
+
+    for raw_line, s in zip(lines[start_idx:], stripped[start_idx:], strict=True):
+        line = raw_line.rstrip()
+        s_lower = s.lower()
+
+        if s_lower.startswith(FOOTER_MARKERS):
+            break
+
+        if s == "## Contents":
+            in_toc = True
+            continue
+        if in_toc:
+            if s.startswith("## "):
+                in_toc = False
+            else:
+                continue
+
+        if s in DROP_EXACT_LINES:
+            continue
+        drop_starts = DROP_LINE_STARTS_BY_FIRST.get(s[:1])
+        if drop_starts is not None and (s.startswith(drop_starts[0]) or s_lower.startswith(drop_starts[1])):
+            continue
+        if "[ctrl-option-" in s_lower:
+            continue
+        if DOCS_VERSIONS_RE.fullmatch(s_lower):
+            continue
+        if "YouTube might collect personal data." in s:
+            continue
+
+        # Remove image-only and link-only markdown artifacts: "![...](...)" and "[...](http(s)://...)".
+        # Prefix/suffix checks match exactly what the former fullmatch regexes did, without backtracking.
+        if s.endswith(")") and (
+            (s.startswith("![") and "](" in s) or (s.startswith("[") and ("](http://" in s or "](https://" in s))
+        ):
+            continue
+
+        # Keep text, drop markdown URL targets. Most lines have no links or code, so each
+        # pass runs only when its delimiter is present (the substitutions never create one).
+        if "](" in line:
+            if "![" in line:
+                line = IMAGE_RE.sub(r"\1", line)
+            line = LINK_RE.sub(r"\1", line)
+        if "`" in line:
+            line = BACKTICKS_RE.sub("", line)
+        out.append(line)
+
+    compact: list[str] = []
+    for line in out:
+        if line.strip() == "" and compact and compact[-1].strip() == "":
+            continue
+        if compact and line.strip() == expected_h1 and compact[-1].strip() == expected_h1:
+            continue
+        compact.append(line)
+
+    # Remove leading nav list under the first H1, e.g.:
+    # # About Moodle FAQ
+    #   * Features
+    #   * ...
+    if compact and compact[0].strip() == expected_h1:
+        i = 1
+        while i < len(compact) and compact[i].strip() == "":
+            i += 1
+        j = i
+        while j < len(compact) and compact[j].lstrip().startswith("* "):
+            j += 1
+        if j - i >= 3:
+            # Drop the list together with the blanks around it: keep the H1, resume at the first non-blank line.
+            while j < len(compact) and compact[j].strip() == "":
+                j += 1
+            compact = [compact[0], *compact[j:]]
+
+    return "\n".join(compact).strip()
+
+
+def build_markdown(title: str, url: str, body_text: str, youtube: list[str], images: list[str]) -> str:
+    heading = f"# {title}"
+    body_lines = body_text.splitlines()
+    n = len(body_lines)
+
+    # Skip leading blanks, repeated headings and a leading nav list by index instead of pop(0).
+    i = 0
+    while i < n and body_lines[i].strip() == "":
+        i += 1
+    while i < n and body_lines[i].strip() == heading:
+        i += 1
+        while i < n and body_lines[i].strip() == "":
+            i += 1
+
+    bullet_end = i
+    while bullet_end < n and body_lines[bullet_end].lstrip().startswith("* "):
+        bullet_end += 1
+    if bullet_end - i >= 3:
+        i = bullet_end
+
+    # Blank lines after the nav list are removed by strip().
+    body_text = "\n".join(body_lines[i:]).strip()
+
+    lines = [heading, "", body_text or "(empty)"]
+    lines.extend(["", "## Sources", f"- [{title}]({url})"])
+
+    if youtube or images:
+        lines.extend(["", "## Media"])
+        if youtube:
+            lines.append("### YouTube")
+            lines.extend(f"- {link}" for link in youtube)
+        if images:
+            lines.append("### Images")
+            lines.extend(f"- {link}" for link in images)
+
+    return "\n".join(lines).strip() + "\n"
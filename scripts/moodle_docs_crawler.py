@@ -18,14 +18,24 @@ import json
 import os
 import re
 from collections import deque
+from collections.abc import Iterator
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from typing import Any
-from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
+from typing import Any, BinaryIO
+from urllib.parse import ParseResult, parse_qsl, urlencode, urljoin, urlparse, urlunparse
 
 # Keep Crawl4AI state inside the project to avoid permission issues.
 os.environ.setdefault("CRAWL4_AI_BASE_DIRECTORY", str(Path.cwd()))
 
+import orjson
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CacheMode, CrawlerRunConfig
+from lxml import etree
+from lxml import html as lxml_html
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows; fall back to the default asyncio loop.
+    uvloop = None  # type: ignore[assignment]
 
 YOUTUBE_HOSTS = (
     "youtube.com",
@@ -36,8 +46,12 @@ YOUTUBE_HOSTS = (
 )
 NOISY_QUERY_PARAMS = {"oldid", "printable", "diff"}
 SKIP_TOKENS = ("special:", "action=edit", "action=history", "veaction=edit", "printable=yes")
-YOUTUBE_URL_RE = re.compile(r'https?://[^\s"\'<>]+', re.IGNORECASE)
-HREF_RE = re.compile(r'href=["\']([^"\']+)["\']', re.IGNORECASE)
+SKIP_RE = re.compile("|".join(map(re.escape, SKIP_TOKENS)))
+HTTP_SCHEMES = frozenset({"http", "https"})
+# Bytes + explicit encoding: lxml rejects str input that carries an XML encoding declaration.
+HTML_PARSER = lxml_html.HTMLParser(encoding="utf-8")
+JSONL_OUTPUTS = ("pages", "images", "youtube", "errors")
+WRITE_BUFFER_SIZE = 1 << 16
 
 
 def ensure_dirs(out_dir: Path, with_screenshots: bool) -> dict[str, Path]:
@@ -54,15 +68,32 @@ def ensure_dirs(out_dir: Path, with_screenshots: bool) -> dict[str, Path]:
     }
 
 
-def append_jsonl(path: Path, payload: dict[str, Any]) -> None:
-    with path.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+@contextmanager
+def open_jsonl_writers(paths: dict[str, Path]) -> Iterator[dict[str, BinaryIO]]:
+    """Keep one buffered append handle per JSONL output for the whole crawl."""
+    with ExitStack() as stack:
+        yield {name: stack.enter_context(paths[name].open("ab", buffering=WRITE_BUFFER_SIZE)) for name in JSONL_OUTPUTS}
 
 
-def normalize_url(url: str) -> str:
+def append_jsonl(f: BinaryIO, payload: dict[str, Any]) -> None:
+    # orjson emits UTF-8 bytes directly, so there is no str encode step on write.
+    f.write(orjson.dumps(payload, option=orjson.OPT_APPEND_NEWLINE))
+
+
+def normalize_parsed(url: str) -> tuple[str, ParseResult]:
+    """Normalize URL and also return its parsed form, so callers don't urlparse it again."""
     parsed = urlparse(url.strip())._replace(fragment="")
     params = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if k.lower() not in NOISY_QUERY_PARAMS]
-    return urlunparse(parsed._replace(query=urlencode(params, doseq=True)))
+    parsed = parsed._replace(query=urlencode(params, doseq=True))
+    normalized = urlunparse(parsed)
+    if not parsed.netloc and parsed.path.startswith("//"):
+        # urlunparse turns "scheme:////host/path" into "scheme://host/path": reparse that rare case.
+        parsed = urlparse(normalized)
+    return normalized, parsed
+
+
+def normalize_url(url: str) -> str:
+    return normalize_parsed(url)[0]
 
 
 def iter_link_urls(items: list[Any] | None) -> list[str]:
@@ -80,55 +111,67 @@ def iter_link_urls(items: list[Any] | None) -> list[str]:
     return urls
 
 
-def normalize_links(base_url: str, items: list[Any] | None) -> list[str]:
-    return sorted({normalize_url(urljoin(base_url, raw)) for raw in iter_link_urls(items)})
+def normalize_links(base_url: str, items: list[Any] | None) -> dict[str, ParseResult]:
+    links: dict[str, ParseResult] = {}
+    for raw in iter_link_urls(items):
+        link, parsed = normalize_parsed(urljoin(base_url, raw))
+        links[link] = parsed
+    return links
+
 
+def parse_html(html: str) -> lxml_html.HtmlElement | None:
+    if not html.strip():
+        return None
+    try:
+        return lxml_html.document_fromstring(html.encode("utf-8"), parser=HTML_PARSER)
+    except (etree.ParserError, ValueError):
+        return None
 
-def extract_links_from_html(base_url: str, html: str) -> tuple[list[str], list[str]]:
-    if not html:
-        return [], []
 
-    internal: set[str] = set()
-    external: set[str] = set()
-    for raw in HREF_RE.findall(html):
+def extract_links_from_html(
+    base_url: str, tree: lxml_html.HtmlElement | None
+) -> tuple[dict[str, ParseResult], dict[str, ParseResult]]:
+    if tree is None:
+        return {}, {}
+
+    internal: dict[str, ParseResult] = {}
+    external: dict[str, ParseResult] = {}
+    for raw in tree.xpath("//@href"):
         href = raw.strip()
         if not href or href.startswith(("#", "javascript:", "mailto:", "tel:")):
             continue
-        link = normalize_url(urljoin(base_url, href))
-        parsed = urlparse(link)
-        if parsed.scheme not in {"http", "https"}:
+        link, parsed = normalize_parsed(urljoin(base_url, href))
+        if parsed.scheme not in HTTP_SCHEMES:
             continue
         if parsed.netloc == "docs.moodle.org":
-            internal.add(link)
+            internal[link] = parsed
         else:
-            external.add(link)
-    return sorted(internal), sorted(external)
+            external[link] = parsed
+    return internal, external
 
 
-def is_moodle_doc_url(url: str, docs_prefix: str) -> bool:
-    parsed = urlparse(url)
-    return (
-        parsed.scheme in {"http", "https"}
-        and parsed.netloc == "docs.moodle.org"
-        and parsed.path.startswith(docs_prefix)
-    )
+def is_moodle_doc_url(parsed: ParseResult, docs_prefix: str) -> bool:
+    return parsed.scheme in HTTP_SCHEMES and parsed.netloc == "docs.moodle.org" and parsed.path.startswith(docs_prefix)
 
 
 def should_skip_url(url: str) -> bool:
-    lowered = url.lower()
-    return any(token in lowered for token in SKIP_TOKENS)
+    return SKIP_RE.search(url.lower()) is not None
+
+
+def is_youtube_host(netloc: str) -> bool:
+    return netloc.lower().endswith(YOUTUBE_HOSTS)
 
 
 def is_youtube_url(url: str) -> bool:
-    host = urlparse(url).netloc.lower()
-    return any(host.endswith(pattern) for pattern in YOUTUBE_HOSTS)
+    return is_youtube_host(urlparse(url).netloc)
 
 
-def extract_youtube_from_html(html: str) -> set[str]:
-    if not html:
+def extract_youtube_from_html(tree: lxml_html.HtmlElement | None) -> set[str]:
+    if tree is None:
         return set()
-    urls = {raw.rstrip(").,;") for raw in YOUTUBE_URL_RE.findall(html)}
-    return {u for u in urls if is_youtube_url(u)}
+    # Links and embedded players (the consent overlay keeps the player URL in data-src).
+    urls = {raw.strip() for raw in tree.xpath("//@href | //iframe/@src | //iframe/@data-src")}
+    return {u for u in urls if u.lower().startswith(("http://", "https://")) and is_youtube_url(u)}
 
 
 def normalize_images(base_url: str, images_raw: list[Any] | None) -> list[dict[str, Any]]:
@@ -201,6 +244,104 @@ def build_browser_config(cookies_file: str | None, user_agent: str | None) -> Br
     return BrowserConfig(**kwargs)
 
 
+class ResultProcessor:
+    """Turns crawl results into JSONL records; runs in a worker thread while the next batch is fetched."""
+
+    def __init__(
+        self,
+        writers: dict[str, BinaryIO],
+        screenshots_dir: Path,
+        docs_prefix: str,
+        with_screenshots: bool,
+    ) -> None:
+        self.writers = writers
+        self.screenshots_dir = screenshots_dir
+        self.docs_prefix = docs_prefix
+        self.with_screenshots = with_screenshots
+        self.success = 0
+        self.failed = 0
+        self.unique_youtube: set[str] = set()
+        self.unique_images: set[str] = set()
+
+    def process_batch(self, results: list[Any]) -> list[str]:
+        """Write records for a batch and return doc links to enqueue, in crawl order."""
+        new_links: list[str] = []
+        for result in results:
+            new_links.extend(self.process_result(result))
+
+        # Flush once per batch so an interrupted crawl keeps everything fetched so far.
+        for f in self.writers.values():
+            f.flush()
+        return new_links
+
+    def process_result(self, result: Any) -> list[str]:
+        url = normalize_url(result.url)
+
+        if not result.success:
+            self.failed += 1
+            append_jsonl(self.writers["errors"], {"url": url, "error": result.error_message})
+            return []
+
+        self.success += 1
+        links = result.links or {}
+        media = result.media or {}
+        metadata = result.metadata or {}
+
+        internal = normalize_links(url, links.get("internal", []))
+        external = normalize_links(url, links.get("external", []))
+        tree = parse_html(result.html or "")
+        if not internal and not external:
+            internal, external = extract_links_from_html(url, tree)
+        internal_urls = sorted(internal)
+        external_urls = sorted(external)
+
+        doc_links = [
+            link
+            for link in internal_urls
+            if is_moodle_doc_url(internal[link], self.docs_prefix) and not should_skip_url(link)
+        ]
+
+        images = normalize_images(url, media.get("images", []))
+        for image in images:
+            src = image.get("src")
+            if not isinstance(src, str) or src in self.unique_images:
+                continue
+            self.unique_images.add(src)
+            append_jsonl(self.writers["images"], {"page_url": url, **image})
+
+        # External links are already normalized; only raw URLs found in HTML need it.
+        youtube_links = {link for link, parsed in external.items() if is_youtube_host(parsed.netloc)}
+        youtube_links.update(normalize_url(link) for link in extract_youtube_from_html(tree))
+
+        for yt in sorted(youtube_links):
+            if yt in self.unique_youtube:
+                continue
+            self.unique_youtube.add(yt)
+            append_jsonl(self.writers["youtube"], {"page_url": url, "youtube_url": yt})
+
+        screenshot_file = None
+        if self.with_screenshots and result.screenshot:
+            screenshot_path = self.screenshots_dir / safe_filename_from_url(url)
+            screenshot_file = write_screenshot(result.screenshot, screenshot_path)
+
+        append_jsonl(
+            self.writers["pages"],
+            {
+                "url": url,
+                "title": metadata.get("title"),
+                "description": metadata.get("description"),
+                "markdown": result.markdown,
+                "html": result.html,
+                "internal_links": internal_urls,
+                "external_links": external_urls,
+                "images": images,
+                "youtube_links": sorted(youtube_links),
+                "screenshot_file": screenshot_file,
+            },
+        )
+        return doc_links
+
+
 async def crawl_moodle_docs(
     start_url: str,
     docs_prefix: str,
@@ -228,106 +369,63 @@ async def crawl_moodle_docs(
 
     page_limit = max_pages if max_pages > 0 else None
     discovered = 0
-    success = 0
-    failed = 0
-    unique_youtube: set[str] = set()
-    unique_images: set[str] = set()
-
-    async with AsyncWebCrawler(config=browser_config) as crawler:
-        while frontier and (page_limit is None or discovered < page_limit):
-            batch: list[str] = []
-            while frontier and len(batch) < max_concurrent:
-                if page_limit is not None and discovered + len(batch) >= page_limit:
-                    break
-                url = frontier.popleft()
-                if url in visited:
-                    continue
-                visited.add(url)
-                batch.append(url)
-            if not batch:
-                continue
-
-            results = await crawler.arun_many(urls=batch, config=run_config, max_concurrent=max_concurrent)
-            for result in results:
-                discovered += 1
-                url = normalize_url(result.url)
-
-                if not result.success:
-                    failed += 1
-                    append_jsonl(paths["errors"], {"url": url, "error": result.error_message})
-                    continue
-
-                success += 1
-                links = result.links or {}
-                media = result.media or {}
-                metadata = result.metadata or {}
 
-                internal_urls = normalize_links(url, links.get("internal", []))
-                external_urls = normalize_links(url, links.get("external", []))
-                if not internal_urls and not external_urls:
-                    html_internal, html_external = extract_links_from_html(url, result.html or "")
-                    internal_urls = html_internal
-                    external_urls = html_external
-
-                for link in internal_urls:
-                    if link in visited or link in queued:
-                        continue
-                    if not is_moodle_doc_url(link, docs_prefix) or should_skip_url(link):
-                        continue
-                    frontier.append(link)
-                    queued.add(link)
-
-                images = normalize_images(url, media.get("images", []))
-                for image in images:
-                    src = image.get("src")
-                    if not isinstance(src, str) or src in unique_images:
+    def enqueue(links: list[str]) -> None:
+        for link in links:
+            if link in visited or link in queued:
+                continue
+            frontier.append(link)
+            queued.add(link)
+
+    with open_jsonl_writers(paths) as writers:
+        processor = ResultProcessor(writers, paths["screenshots"], docs_prefix, with_screenshots)
+        # Post-processing of batch N (parsing, JSONL, screenshots) runs in a thread
+        # while the browser fetches batch N+1.
+        pending: asyncio.Task[list[str]] | None = None
+
+        async with AsyncWebCrawler(config=browser_config) as crawler:
+            while (frontier or pending) and (page_limit is None or discovered < page_limit):
+                batch: list[str] = []
+                while frontier and len(batch) < max_concurrent:
+                    if page_limit is not None and discovered + len(batch) >= page_limit:
+                        break
+                    url = frontier.popleft()
+                    if url in visited:
                         continue
-                    unique_images.add(src)
-                    append_jsonl(paths["images"], {"page_url": url, **image})
-
-                youtube_links = {link for link in external_urls if is_youtube_url(link)}
-                youtube_links.update(extract_youtube_from_html(result.html or ""))
-                youtube_links = {normalize_url(link) for link in youtube_links}
+                    visited.add(url)
+                    batch.append(url)
+                if not batch:
+                    # Nothing to fetch until the previous batch yields new links.
+                    if pending is not None:
+                        enqueue(await pending)
+                        pending = None
+                    continue
 
-                for yt in sorted(youtube_links):
-                    if yt in unique_youtube:
-                        continue
-                    unique_youtube.add(yt)
-                    append_jsonl(paths["youtube"], {"page_url": url, "youtube_url": yt})
-
-                screenshot_file = None
-                if with_screenshots and result.screenshot:
-                    screenshot_path = paths["screenshots"] / safe_filename_from_url(url)
-                    screenshot_file = write_screenshot(result.screenshot, screenshot_path)
-
-                append_jsonl(
-                    paths["pages"],
-                    {
-                        "url": url,
-                        "title": metadata.get("title"),
-                        "description": metadata.get("description"),
-                        "markdown": result.markdown,
-                        "html": result.html,
-                        "internal_links": internal_urls,
-                        "external_links": external_urls,
-                        "images": images,
-                        "youtube_links": sorted(youtube_links),
-                        "screenshot_file": screenshot_file,
-                    },
+                fetch = crawler.arun_many(urls=batch, config=run_config, max_concurrent=max_concurrent)
+                if pending is not None:
+                    results, new_links = await asyncio.gather(fetch, pending)
+                    enqueue(new_links)
+                else:
+                    results = await fetch
+                discovered += len(results)
+                pending = asyncio.create_task(asyncio.to_thread(processor.process_batch, results))
+
+                if delay_seconds > 0:
+                    await asyncio.sleep(delay_seconds)
+
+                print(
+                    f"Processed={discovered} Success={processor.success} Failed={processor.failed} "
+                    f"Queue={len(frontier)} YouTube={len(processor.unique_youtube)} "
+                    f"Images={len(processor.unique_images)}"
                 )
 
-            if delay_seconds > 0:
-                await asyncio.sleep(delay_seconds)
-
-            print(
-                f"Processed={discovered} Success={success} Failed={failed} "
-                f"Queue={len(frontier)} YouTube={len(unique_youtube)} Images={len(unique_images)}"
-            )
+            if pending is not None:
+                await pending
 
     print("Crawl finished.")
     print(f"Output dir: {out_dir}")
-    print(f"Pages: {success}, Failed: {failed}, Discovered: {discovered}")
-    print(f"Unique images: {len(unique_images)}, Unique YouTube links: {len(unique_youtube)}")
+    print(f"Pages: {processor.success}, Failed: {processor.failed}, Discovered: {discovered}")
+    print(f"Unique images: {len(processor.unique_images)}, Unique YouTube links: {len(processor.unique_youtube)}")
 
 
 def parse_args() -> argparse.Namespace:
@@ -355,7 +453,8 @@ def parse_args() -> argparse.Namespace:
 
 def main() -> None:
     args = parse_args()
-    asyncio.run(
+    run = uvloop.run if uvloop is not None else asyncio.run
+    run(
         crawl_moodle_docs(
             start_url=args.start_url,
             docs_prefix=args.docs_prefix,
@@ -1,11 +1,28 @@
+"""Build the cleaned markdown corpus (JSONL + one .md per page) from the crawler's pages.jsonl.
+
+Run from the project root: python -m scripts.prepare_markdown_corpus
+"""
+
 import argparse
-import json
+import os
 import re
 from collections.abc import Generator
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO
 from urllib.parse import urlparse, urlunparse
 
+import orjson
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional (the "corpus" extra): without it markers are searched one by one.
+    ahocorasick = None
+
+from scripts.markdown_cleaner import build_markdown, clean_title, strip_markdown_to_text
+
 CHALLENGE_MARKERS = (
     "just a moment",
     "one moment",
@@ -17,59 +34,18 @@ CHALLENGE_MARKERS = (
     "egy pillanat",
 )
 
-FOOTER_MARKERS = (
-    'retrieved from "[',
-    "[tools](",
-    "[what links here](",
-    "[related changes](",
-    "[special pages](",
-    "[printable version](",
-    "[permanent link](",
-    "[page information](",
-    "[in other languages](",
-    "this page was last edited",
-    "content is available under",
-    "[privacy](",
-    "[about moodle docs](",
-    "[disclaimers](",
-    "[accessibility statement](",
-    "[![powered by mediawiki]",
-)
-BAD_YOUTUBE_PATTERNS = ("youtube.com/howyoutubeworks/user-settings/privacy",)
-
-DROP_EXACT_LINES = {
-    "Menu",
-    "Main page",
-    "Table of contents",
-    "Docs overview",
-    "Recent changes",
-    "Log in",
-    "Article",
-    "View history",
-    "From MoodleDocs",
-    "Load video",
-    "YouTube",
-    "Continue",
-    "---",
-}
-
-DROP_LINE_STARTS = (
-    "# Documentation",
-    "[Main page](",
-    "[Table of contents](",
-    "[Docs overview](",
-    "[Recent changes](",
-    "[Random page](",
-    "[Category index](",
-    "[Global search](",
-    "[log in](",
-    "[4.5 docs](",
-    "[4.4 docs](",
-    "[article](",
-    "[page comments](",
-    "[view source](",
-    "[view history](",
-)
+BAD_YOUTUBE_PATTERN = "youtube.com/howyoutubeworks/user-settings/privacy"
+
+READ_CHUNK_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+MD_WRITE_THREADS = 8
+# Upper bound on .md writes waiting in the thread pool, so finished markdown doesn't pile up in memory.
+MAX_PENDING_WRITES = 256
+
+SLUG_UNSAFE_RE = re.compile(r"[^a-zA-Z0-9._-]+")
+
+# Each worker process reads its rows from its own handle to the input file.
+_input: BinaryIO | None = None
 
 
 def parse_args() -> argparse.Namespace:
@@ -96,25 +72,58 @@ def parse_args() -> argparse.Namespace:
         default="data/moodle_docs/youtube_links.jsonl",
         help="Path to youtube_links.jsonl (page_url + youtube_url).",
     )
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes. Use 0 for os.cpu_count().")
     return parser.parse_args()
 
 
+# The same page, image and YouTube URLs repeat across rows; urlparse/urlunparse run once per distinct string.
+@lru_cache(maxsize=100_000)
 def normalize_url(url: str) -> str:
     parsed = urlparse((url or "").strip())._replace(fragment="")
     return urlunparse(parsed)
 
 
+def iter_jsonl_with_offsets(path: Path) -> "Generator[tuple[int, dict[str, Any]], None, None]":
+    """Yield (byte offset of the line, record); read_jsonl_at can load the record again by its offset."""
+    # Raw 1 MiB reads split on b"\n": no TextIOWrapper decoding or per-line readline overhead.
+    # Blank lines are skipped; surrounding whitespace is valid JSON, so lines go to the parser as is.
+    partial: list[bytes] = []
+    line_start = 0
+    with path.open("rb", buffering=0) as f:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            lines = chunk.split(b"\n")
+            if len(lines) == 1:
+                partial.append(chunk)
+                continue
+            if partial:
+                partial.append(lines[0])
+                lines[0] = b"".join(partial)
+            # The last piece is an incomplete line (or b"" when the chunk ends with a newline).
+            partial = [lines.pop()]
+            for line in lines:
+                if line and not line.isspace():
+                    yield line_start, orjson.loads(line)
+                line_start += len(line) + 1
+
+    line = b"".join(partial)
+    if line and not line.isspace():
+        yield line_start, orjson.loads(line)
+
+
 def iter_jsonl(path: Path) -> "Generator[dict[str, Any], None, None]":
-    with path.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                yield json.loads(line)
+    for _, row in iter_jsonl_with_offsets(path):
+        yield row
+
 
+def read_jsonl_at(f: BinaryIO, offset: int) -> dict[str, Any]:
+    f.seek(offset)
+    return orjson.loads(f.readline())  # type: ignore[no-any-return]
 
+
+@lru_cache(maxsize=100_000)
 def is_blocked_youtube(url: str) -> bool:
     lowered = normalize_url(url).lower().rstrip("/")
-    return any(pattern in lowered for pattern in BAD_YOUTUBE_PATTERNS)
+    return BAD_YOUTUBE_PATTERN in lowered
 
 
 def load_youtube_links_map(path: Path) -> dict[str, set[str]]:
@@ -134,99 +143,32 @@ def load_youtube_links_map(path: Path) -> dict[str, set[str]]:
     return by_page
 
 
-def is_challenge_page(title: str, markdown: str) -> bool:
-    haystack = ((title or "") + "\n" + (markdown or "")[:4000]).lower()
-    return any(marker in haystack for marker in CHALLENGE_MARKERS)
-
-
-def clean_title(title: str, fallback: str = "Untitled") -> str:
-    raw = (title or "").strip()
-    if not raw:
-        return fallback
-    return raw.split(" - ", 1)[0].strip() or fallback
-
-
-def strip_markdown_to_text(markdown: str, title: str) -> str:
-    lines = markdown.splitlines()
-    expected_h1 = f"# {title}".strip()
-    start_idx = 0
-    for i, line in enumerate(lines):
-        if line.strip() == expected_h1:
-            start_idx = i
-            break
-    else:
-        for i, line in enumerate(lines):
-            if line.strip().startswith("# "):
-                start_idx = i
-                break
-
-    lines = lines[start_idx:]
-    out: list[str] = []
-    in_toc = False
-
-    for raw_line in lines:
-        line = raw_line.rstrip()
-        s = line.strip()
-        s_lower = s.lower()
-
-        if any(s_lower.startswith(marker) for marker in FOOTER_MARKERS):
-            break
-
-        if s == "## Contents":
-            in_toc = True
-            continue
-        if in_toc:
-            if s.startswith("## "):
-                in_toc = False
-            else:
-                continue
+def build_marker_automaton(markers: tuple[str, ...]) -> Any:
+    """Aho-Corasick automaton finding any of the markers in one pass, or None without pyahocorasick."""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for marker in markers:
+        automaton.add_word(marker, marker)
+    automaton.make_automaton()
+    return automaton
 
-        if s in DROP_EXACT_LINES:
-            continue
-        if s.startswith(DROP_LINE_STARTS) or s_lower.startswith(DROP_LINE_STARTS):
-            continue
-        if "[ctrl-option-" in s_lower:
-            continue
-        if re.fullmatch(r"\d\.\d docs(?: \d\.\d docs)+", s_lower):
-            continue
-        if "YouTube might collect personal data." in s:
-            continue
 
-        # Remove image-only markdown artifacts.
-        if re.fullmatch(r"!\[.*\]\(.*\)", s) or re.fullmatch(r"\[\s*.*\s*\]\(https?://.*\)", s):
-            continue
+CHALLENGE_AUTOMATON = build_marker_automaton(CHALLENGE_MARKERS)
 
-        # Keep text, drop markdown URL targets.
-        line = re.sub(r"!\[([^\]]*)\]\(([^)]+)\)", r"\1", line)
-        line = re.sub(r"\[([^\]]+)\]\(([^)]+)\)", r"\1", line)
-        line = re.sub(r"`{1,3}", "", line)
-        out.append(line)
 
-    compact: list[str] = []
-    for line in out:
-        if line.strip() == "" and compact and compact[-1].strip() == "":
-            continue
-        if compact and line.strip() == expected_h1 and compact[-1].strip() == expected_h1:
-            continue
-        compact.append(line)
-
-    # Remove leading nav list under the first H1, e.g.:
-    # # About Moodle FAQ
-    #   * Features
-    #   * ...
-    if compact and compact[0].strip() == expected_h1:
-        i = 1
-        while i < len(compact) and compact[i].strip() == "":
-            i += 1
-        j = i
-        while j < len(compact) and compact[j].lstrip().startswith("* "):
-            j += 1
-        if j - i >= 3:
-            compact = compact[:i] + compact[j:]
-            while len(compact) > 1 and compact[1].strip() == "":
-                compact.pop(1)
-
-    return "\n".join(compact).strip()
+def has_challenge_marker(text: str) -> bool:
+    if CHALLENGE_AUTOMATON is not None:
+        return next(CHALLENGE_AUTOMATON.iter(text), None) is not None
+    return any(marker in text for marker in CHALLENGE_MARKERS)
+
+
+def is_challenge_page(title: str, markdown: str) -> bool:
+    # Title and markdown are checked separately (no marker contains "\n"), so the short title often
+    # answers without building and lowercasing the joined string.
+    if title and has_challenge_marker(title.lower()):
+        return True
+    return bool(markdown) and has_challenge_marker(markdown[:4000].lower())
 
 
 def related_media_links(row: dict[str, Any], youtube_from_jsonl: set[str] | None) -> tuple[list[str], list[str]]:
@@ -252,46 +194,46 @@ def related_media_links(row: dict[str, Any], youtube_from_jsonl: set[str] | None
     return youtube, sorted(image_links)
 
 
-def build_markdown(title: str, url: str, body_text: str, youtube: list[str], images: list[str]) -> str:
-    heading = f"# {title}"
-    body_lines = body_text.splitlines()
+def slug_from_url(url: str) -> str:
+    path = urlparse(url).path.strip("/")
+    if not path:
+        return "page"
+    # sub() replaces runs with "_", so a non-empty path never turns into an empty slug.
+    return SLUG_UNSAFE_RE.sub("_", path.replace("/", "__"))
 
-    while body_lines and body_lines[0].strip() == "":
-        body_lines.pop(0)
-    while body_lines and body_lines[0].strip() == heading:
-        body_lines.pop(0)
-        while body_lines and body_lines[0].strip() == "":
-            body_lines.pop(0)
 
-    bullet_end = 0
-    while bullet_end < len(body_lines) and body_lines[bullet_end].lstrip().startswith("* "):
-        bullet_end += 1
-    if bullet_end >= 3:
-        body_lines = body_lines[bullet_end:]
-        while body_lines and body_lines[0].strip() == "":
-            body_lines.pop(0)
+def write_bytes(path: Path, data: bytes) -> None:
+    path.write_bytes(data)
 
-    body_text = "\n".join(body_lines).strip()
 
-    lines = [heading, "", body_text or "(empty)"]
-    lines.extend(["", "## Sources", f"- [{title}]({url})"])
+def init_worker(input_path: Path) -> None:
+    global _input
+    _input = input_path.open("rb")
 
-    if youtube or images:
-        lines.extend(["", "## Media"])
-        if youtube:
-            lines.append("### YouTube")
-            lines.extend(f"- {link}" for link in youtube)
-        if images:
-            lines.append("### Images")
-            lines.extend(f"- {link}" for link in images)
 
-    return "\n".join(lines).strip() + "\n"
+def clean_row(task: tuple[str, int, set[str] | None]) -> tuple[str, bytes, bytes]:
+    """Re-read the winning row for a URL and build its JSONL line and .md contents (runs in a worker process).
 
+    Both outputs come back already encoded, so the main process only writes bytes.
+    """
+    url, offset, youtube_from_jsonl = task
+    assert _input is not None
+    row = read_jsonl_at(_input, offset)
+    title = clean_title(row.get("title") or "", fallback="Untitled")
+    body_text = strip_markdown_to_text(row.get("markdown") or "", title)
+    youtube, images = related_media_links(row, youtube_from_jsonl)
+    markdown_clean = build_markdown(title, url, body_text, youtube, images)
 
-def slug_from_url(url: str) -> str:
-    slug = urlparse(url).path.strip("/").replace("/", "__")
-    slug = re.sub(r"[^a-zA-Z0-9._-]+", "_", slug)
-    return slug or "page"
+    payload = {
+        "url": url,
+        "title": title,
+        "markdown_clean": markdown_clean,
+        "youtube_links": youtube,
+        "image_links": images,
+        "source": {"title": title, "url": url},
+    }
+    # orjson writes UTF-8 as is, same as json.dumps(ensure_ascii=False).
+    return url, orjson.dumps(payload, option=orjson.OPT_APPEND_NEWLINE), markdown_clean.encode("utf-8")
 
 
 def main() -> None:
@@ -304,13 +246,14 @@ def main() -> None:
     output_md_dir.mkdir(parents=True, exist_ok=True)
     youtube_by_page = load_youtube_links_map(youtube_links_path)
 
-    by_url: dict[str, dict[str, Any]] = {}
+    # Only (markdown length, line offset) per URL: the winning rows are re-read from the input on the second pass.
+    by_url: dict[str, tuple[int, int]] = {}
     total = 0
     skipped_missing = 0
     skipped_challenge = 0
     skipped_short = 0
 
-    for row in iter_jsonl(input_path):
+    for offset, row in iter_jsonl_with_offsets(input_path):
         total += 1
         url = normalize_url(row.get("url") or "")
         markdown = row.get("markdown") or ""
@@ -327,32 +270,37 @@ def main() -> None:
             continue
 
         current = by_url.get(url)
-        if current is None or len(markdown) > len(current.get("markdown") or ""):
-            by_url[url] = row
+        if current is None or len(markdown) > current[0]:
+            by_url[url] = (len(markdown), offset)
 
     kept = 0
-    with output_jsonl.open("w", encoding="utf-8") as out:
-        for url in sorted(by_url):
-            row = by_url[url]
-            title = clean_title(row.get("title") or "", fallback="Untitled")
-            body_text = strip_markdown_to_text(row.get("markdown") or "", title)
-            youtube, images = related_media_links(row, youtube_by_page.get(url))
-            markdown_clean = build_markdown(title, url, body_text, youtube, images)
-
-            payload = {
-                "url": url,
-                "title": title,
-                "markdown_clean": markdown_clean,
-                "youtube_links": youtube,
-                "image_links": images,
-                "source": {"title": title, "url": url},
-            }
-            out.write(json.dumps(payload, ensure_ascii=False) + "\n")
+    workers = args.workers or os.cpu_count() or 1
+    # Rows only carry (url, offset): workers read the records themselves, so no HTML goes through pickle.
+    # imap (not imap_unordered) keeps the output in sorted URL order.
+    tasks = ((url, by_url[url][1], youtube_by_page.get(url)) for url in sorted(by_url))
+    pending_writes: dict[Path, Future[None]] = {}
+    with (
+        Pool(processes=workers, initializer=init_worker, initargs=(input_path,)) as pool,
+        ThreadPoolExecutor(max_workers=MD_WRITE_THREADS) as writer,
+        output_jsonl.open("wb", buffering=WRITE_BUFFER_SIZE) as out,
+    ):
+        for url, jsonl_line, markdown_bytes in pool.imap(clean_row, tasks, chunksize=64):
+            out.write(jsonl_line)
 
             md_path = output_md_dir / f"{slug_from_url(url)}.md"
-            md_path.write_text(markdown_clean, encoding="utf-8")
+            # Several URLs can share a slug and the later one must win, as with sequential writes.
+            earlier = pending_writes.pop(md_path, None)
+            if earlier is not None:
+                earlier.result()
+            pending_writes[md_path] = writer.submit(write_bytes, md_path, markdown_bytes)
+            if len(pending_writes) >= MAX_PENDING_WRITES:
+                pending_writes.pop(next(iter(pending_writes))).result()
             kept += 1
 
+        # result() re-raises write errors in the main thread.
+        for future in pending_writes.values():
+            future.result()
+
     print("Done.")
     print(f"Input rows: {total}")
     print(f"Kept rows: {kept}")